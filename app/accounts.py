@@ -0,0 +1,84 @@
+"""Account helpers shared by the API and the bulk importer (no web wiring)."""
+import os, uuid
+
+from sqlalchemy import text
+
+from .plex_service import invite_user
+
+DEFAULT_PLAN_PRICE = float(os.getenv("DEFAULT_PLAN_PRICE", "9.00"))
+DEFAULT_PLAN_NAME = os.getenv("DEFAULT_PLAN_NAME", "Standard")
+
+
+def send_plex_invite(conn, user_id: str, email: str, full_name: str) -> str:
+    """Send a Plex invite and record the attempt in invites/users. Returns the stored status."""
+    try:
+        status = invite_user(email, full_name)
+
+        conn.execute(
+            text(
+                """
+                INSERT INTO invites(
+                    invite_id, user_id, email, plex_server,
+                    sent_at, status, attempts
+                )
+                VALUES(
+                    :iid, :uid, :email, :server,
+                    NOW(), :status, 1
+                )
+                """
+            ),
+            dict(
+                iid=f"i_{uuid.uuid4().hex[:10]}",
+                uid=user_id,
+                email=email,
+                server=os.getenv("PLEX_SERVER_NAME", ""),
+                status=status,
+            ),
+        )
+
+        conn.execute(
+            text(
+                """
+                UPDATE users
+                SET plex_invite_status = :status
+                WHERE email = :email
+                """
+            ),
+            dict(email=email, status=status),
+        )
+        return status
+
+    except Exception as ex:
+        conn.execute(
+            text(
+                """
+                INSERT INTO invites(
+                    invite_id, user_id, email, plex_server,
+                    sent_at, status, error_message, attempts
+                )
+                VALUES(
+                    :iid, :uid, :email, :server,
+                    NOW(), 'error', :msg, 1
+                )
+                """
+            ),
+            dict(
+                iid=f"i_{uuid.uuid4().hex[:10]}",
+                uid=user_id,
+                email=email,
+                server=os.getenv("PLEX_SERVER_NAME", ""),
+                msg=str(ex),
+            ),
+        )
+
+        conn.execute(
+            text(
+                """
+                UPDATE users
+                SET plex_invite_status = 'error'
+                WHERE email = :email
+                """
+            ),
+            dict(email=email),
+        )
+        return "error"
@@ -4,8 +4,26 @@ import os
 DATABASE_URL = os.getenv("DATABASE_URL")
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 
+# Advisory lock namespaces (first key of pg_advisory_xact_lock(int, int))
+LOCK_NS_SCHEMA = 1
+LOCK_NS_USER = 2
+
+def lock_user(conn, email: str):
+    """
+    Serialize work on one user across workers/instances.
+
+    Takes a transaction-scoped Postgres advisory lock keyed by the email;
+    it is released automatically when the surrounding transaction ends.
+    """
+    conn.execute(
+        text("SELECT pg_advisory_xact_lock(:ns, hashtext(:key))"),
+        dict(ns=LOCK_NS_USER, key=email.lower()),
+    )
+
 def init_db():
     with engine.begin() as conn:
+        # Several workers run this on startup; concurrent CREATE TABLE IF NOT EXISTS can still collide
+        conn.execute(text("SELECT pg_advisory_xact_lock(:ns, 0)"), dict(ns=LOCK_NS_SCHEMA))
         conn.execute(text("""
         CREATE TABLE IF NOT EXISTS users(
           user_id TEXT PRIMARY KEY,
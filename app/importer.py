@@ -0,0 +1,416 @@
+"""
+Bulk import of subscribers and historical Wave payments.
+
+Streams CSV/NDJSON into temp staging tables with Postgres COPY, then merges into
+`users` / `payments` with set-based upserts (payments honor the existing
+`provider_event_id` / `idempotency_key` uniqueness, so re-running an import is safe).
+If a live webhook writes one of the same rows mid-import, the merge is retried.
+Plex invites and Google Sheets rows are skipped unless asked for, and run after
+the database work has committed.
+
+Usage:
+    python -m app.importer users subscribers.csv [--invite] [--sheets]
+    python -m app.importer payments wave_history.ndjson [--invite] [--sheets]
+"""
+import argparse, csv, io, json, sys, time
+
+import psycopg2.errors
+from sqlalchemy import text
+
+from .db import engine, init_db, lock_user
+from .accounts import send_plex_invite, DEFAULT_PLAN_NAME, DEFAULT_PLAN_PRICE
+from . import sheets
+
+USER_COLUMNS = [
+    "email", "full_name", "plex_username", "status", "join_date", "last_paid_date",
+    "next_due_date", "plan", "monthly_price", "credits_balance", "plex_invite_status",
+    "plex_account_id", "notes",
+]
+
+PAYMENT_COLUMNS = [
+    "payment_id", "email", "full_name", "amount", "currency", "provider", "provider_event_id",
+    "paid_at", "period_start", "period_end", "status", "idempotency_key", "raw_payload",
+]
+
+SHEETS_BATCH = 1000
+
+# Merge attempts when a concurrent webhook write trips a unique constraint
+MERGE_ATTEMPTS = 3
+
+STAGING_TABLES = ["import_users", "import_users_new", "import_payments", "import_payments_new"]
+
+
+def log(msg):
+    print(f"[import] {msg}", file=sys.stderr, flush=True)
+
+
+def read_records(path: str, fmt: str):
+    """Yield one dict per input row from a CSV (with header) or NDJSON file."""
+    # utf-8-sig drops the byte-order mark spreadsheet exports put before the first header
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            if "email" not in (reader.fieldnames or []):
+                raise ValueError(f"{path}: CSV header has no 'email' column (got {reader.fieldnames})")
+            yield from reader
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _user_row(rec: dict):
+    return [rec.get(c) for c in USER_COLUMNS]
+
+
+def _payment_row(rec: dict):
+    row = []
+    for c in PAYMENT_COLUMNS:
+        if c == "raw_payload":
+            row.append(json.dumps(rec))
+        else:
+            row.append(rec.get(c))
+    return row
+
+
+def _clean(value):
+    # COPY treats an unquoted empty CSV field as NULL
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def copy_into_staging(cur, table: str, columns: list, records, to_row, batch_size: int):
+    """COPY records into a staging table in batches. Returns (staged, skipped)."""
+    sql = f"COPY {table}({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    email_idx = columns.index("email")
+    staged = skipped = 0
+    started = time.monotonic()
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    pending = 0
+
+    def flush():
+        nonlocal buf, writer, pending
+        if not pending:
+            return
+        buf.seek(0)
+        cur.copy_expert(sql, buf)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        pending = 0
+        elapsed = time.monotonic() - started
+        log(f"{table}: {staged} rows staged ({staged / max(elapsed, 1e-6):,.0f} rows/s)")
+
+    for rec in records:
+        row = [_clean(v) for v in to_row(rec)]
+        if not row[email_idx]:
+            skipped += 1
+            continue
+        row[email_idx] = row[email_idx].lower()
+        writer.writerow(row)
+        staged += 1
+        pending += 1
+        if pending >= batch_size:
+            flush()
+    flush()
+    return staged, skipped
+
+
+def import_users(cur, records, batch_size: int):
+    cur.execute(f"""
+        CREATE TEMP TABLE import_users(
+          ord BIGSERIAL,
+          {', '.join(f'{c} TEXT' for c in USER_COLUMNS)}
+        )
+    """)
+    cur.execute("CREATE TEMP TABLE import_users_new(user_id TEXT, email TEXT)")
+    staged, skipped = copy_into_staging(cur, "import_users", USER_COLUMNS, records, _user_row, batch_size)
+
+    # Last row wins when the same email appears more than once
+    latest = """
+        SELECT DISTINCT ON (email) * FROM import_users ORDER BY email, ord DESC
+    """
+    cur.execute(f"""
+        UPDATE users u SET
+          full_name          = COALESCE(s.full_name, u.full_name),
+          plex_username      = COALESCE(s.plex_username, u.plex_username),
+          status             = COALESCE(s.status, u.status),
+          join_date          = COALESCE(s.join_date::timestamp, u.join_date),
+          last_paid_date     = COALESCE(s.last_paid_date::timestamp, u.last_paid_date),
+          next_due_date      = COALESCE(s.next_due_date::timestamp, u.next_due_date),
+          plan               = COALESCE(s.plan, u.plan),
+          monthly_price      = COALESCE(s.monthly_price::numeric, u.monthly_price),
+          credits_balance    = COALESCE(s.credits_balance::numeric, u.credits_balance),
+          plex_invite_status = COALESCE(s.plex_invite_status, u.plex_invite_status),
+          plex_account_id    = COALESCE(s.plex_account_id, u.plex_account_id),
+          notes              = COALESCE(s.notes, u.notes)
+        FROM ({latest}) s
+        WHERE u.email = s.email
+    """)
+    updated = cur.rowcount
+
+    cur.execute(f"""
+        WITH ins AS (
+          INSERT INTO users(
+            user_id, email, full_name, plex_username, status, join_date, last_paid_date,
+            next_due_date, plan, monthly_price, credits_balance, plex_invite_status,
+            plex_account_id, notes
+          )
+          SELECT
+            'u_' || substr(md5(random()::text || s.email), 1, 10), s.email,
+            COALESCE(s.full_name, ''), s.plex_username, COALESCE(s.status, 'active'),
+            COALESCE(s.join_date::timestamp, NOW()), s.last_paid_date::timestamp,
+            s.next_due_date::timestamp, COALESCE(s.plan, %(plan)s),
+            COALESCE(s.monthly_price::numeric, %(price)s), COALESCE(s.credits_balance::numeric, 0),
+            s.plex_invite_status, s.plex_account_id, COALESCE(s.notes, 'Bulk import')
+          FROM ({latest}) s
+          ON CONFLICT (email) DO NOTHING
+          RETURNING user_id, email
+        )
+        INSERT INTO import_users_new SELECT user_id, email FROM ins
+    """, dict(plan=DEFAULT_PLAN_NAME, price=DEFAULT_PLAN_PRICE))
+    inserted = cur.rowcount
+
+    cur.execute("""
+        INSERT INTO audit_log(event, details)
+        VALUES('bulk_import_users', %(details)s)
+    """, dict(details=f"staged={staged}, inserted={inserted}, updated={updated}, skipped={skipped}"))
+
+    return dict(staged=staged, skipped=skipped, inserted=inserted, updated=updated)
+
+
+def import_payments(cur, records, batch_size: int):
+    cur.execute(f"""
+        CREATE TEMP TABLE import_payments(
+          ord BIGSERIAL,
+          {', '.join(f'{c} TEXT' for c in PAYMENT_COLUMNS)}
+        )
+    """)
+    cur.execute("CREATE TEMP TABLE import_payments_new(payment_id TEXT, email TEXT)")
+    staged, skipped = copy_into_staging(cur, "import_payments", PAYMENT_COLUMNS, records, _payment_row, batch_size)
+
+    # Same defaults as upsert_user for payers we haven't seen yet
+    cur.execute("""
+        INSERT INTO users(user_id, email, full_name, status, join_date, plan, monthly_price)
+        SELECT DISTINCT ON (email)
+          'u_' || substr(md5(random()::text || email), 1, 10), email, COALESCE(full_name, ''),
+          'active', NOW(), %(plan)s, %(price)s
+        FROM import_payments
+        ORDER BY email, ord
+        ON CONFLICT (email) DO NOTHING
+    """, dict(plan=DEFAULT_PLAN_NAME, price=DEFAULT_PLAN_PRICE))
+    new_users = cur.rowcount
+
+    # Same key the webhook derives; without a period_start fall back to the
+    # provider event id so undated history rows don't collapse into one
+    cur.execute("""
+        UPDATE import_payments SET idempotency_key = CASE
+          WHEN period_start IS NOT NULL THEN email || '-' || period_start
+          ELSE provider_event_id
+        END
+        WHERE idempotency_key IS NULL
+    """)
+    cur.execute("DELETE FROM import_payments WHERE idempotency_key IS NULL")
+    rejected = cur.rowcount
+    if rejected:
+        log(f"payments: {rejected} rows rejected (no idempotency_key, period_start or provider_event_id)")
+
+    # Keep the first row per provider_event_id / idempotency_key within the file and
+    # anything already in payments; the insert itself has no ON CONFLICT, so a
+    # payment_id collision raises instead of silently dropping a payment
+    cur.execute("""
+        WITH ranked AS (
+          SELECT s.*,
+            row_number() OVER (PARTITION BY idempotency_key ORDER BY ord) AS key_rank,
+            row_number() OVER (PARTITION BY provider_event_id ORDER BY ord) AS event_rank
+          FROM import_payments s
+        ),
+        ins AS (
+          INSERT INTO payments(
+            payment_id, user_id, email, amount, currency, provider,
+            provider_event_id, paid_at, period_start, period_end,
+            status, idempotency_key, raw_payload
+          )
+          SELECT
+            COALESCE(s.payment_id, 'p_' || md5(random()::text || clock_timestamp()::text || s.ord::text)),
+            u.user_id, s.email, COALESCE(s.amount::numeric, 0), COALESCE(s.currency, 'USD'),
+            COALESCE(s.provider, 'Wave'), s.provider_event_id,
+            s.paid_at::timestamp, s.period_start::date, s.period_end::date,
+            COALESCE(s.status, 'succeeded'), s.idempotency_key, CAST(s.raw_payload AS JSONB)
+          FROM ranked s
+          JOIN users u ON u.email = s.email
+          WHERE s.key_rank = 1
+            AND (s.provider_event_id IS NULL OR s.event_rank = 1)
+            AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.idempotency_key = s.idempotency_key)
+            AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.provider_event_id = s.provider_event_id)
+          ORDER BY s.ord
+          RETURNING payment_id, email
+        )
+        INSERT INTO import_payments_new SELECT payment_id, email FROM ins
+    """)
+    inserted = cur.rowcount
+    duplicates = staged - rejected - inserted
+
+    # Paid dates follow the newest successful payment, never moving backwards.
+    # Undated history rows keep paid_at NULL and don't count as a recent payment.
+    cur.execute("""
+        UPDATE users u SET
+          last_paid_date = GREATEST(u.last_paid_date, p.paid_at),
+          next_due_date  = GREATEST(u.next_due_date, p.paid_at + INTERVAL '30 days')
+        FROM (
+          SELECT p.email, MAX(p.paid_at) AS paid_at
+          FROM payments p
+          JOIN import_payments_new n ON n.payment_id = p.payment_id
+          WHERE p.status = 'succeeded' AND p.paid_at IS NOT NULL
+          GROUP BY p.email
+        ) p
+        WHERE u.email = p.email
+    """)
+
+    cur.execute("""
+        INSERT INTO audit_log(event, details)
+        VALUES('bulk_import_payments', %(details)s)
+    """, dict(details=f"staged={staged}, inserted={inserted}, duplicates={duplicates}, "
+                      f"rejected={rejected}, new_users={new_users}, skipped={skipped}"))
+
+    return dict(staged=staged, skipped=skipped, inserted=inserted, duplicates=duplicates,
+                rejected=rejected, new_users=new_users)
+
+
+def invite_candidates(cur, kind: str):
+    """Emails touched by this import whose Plex invite hasn't gone out (same rule as the webhook)."""
+    source = "import_users" if kind == "users" else "import_payments_new"
+    cur.execute(f"""
+        SELECT DISTINCT u.email, u.full_name
+        FROM users u
+        JOIN {source} s ON s.email = u.email
+        WHERE u.plex_invite_status IS NULL OR u.plex_invite_status NOT IN ('sent', 'accepted')
+        ORDER BY u.email
+    """)
+    return cur.fetchall()
+
+
+def sheet_rows(cur, kind: str):
+    """Rows for the Users/Payments tabs, in the same layout the API endpoints write."""
+    if kind == "users":
+        cur.execute("""
+            SELECT u.user_id, u.email, u.full_name, u.plex_username, '', u.status,
+                   u.join_date::date::text, COALESCE(u.last_paid_date::date::text, ''),
+                   COALESCE(u.next_due_date::date::text, ''), u.plan, u.monthly_price::text,
+                   COALESCE(u.credits_balance, 0)::text, COALESCE(u.plex_invite_status, ''),
+                   COALESCE(u.plex_account_id, ''), COALESCE(u.notes, '')
+            FROM users u
+            JOIN import_users_new n ON n.user_id = u.user_id
+            ORDER BY u.email
+        """)
+        return "Users", [[v if v is not None else "" for v in r] for r in cur.fetchall()]
+
+    cur.execute("""
+        SELECT p.paid_at::text, p.email, p.amount::float, p.currency, p.provider_event_id,
+               p.period_start::text, p.period_end::text, p.idempotency_key, 'imported'
+        FROM payments p
+        JOIN import_payments_new n ON n.payment_id = p.payment_id
+        ORDER BY p.paid_at
+    """)
+    return "Payments", [[v if v is not None else "" for v in r] for r in cur.fetchall()]
+
+
+def send_invites(candidates):
+    """Deferred Plex invites, one short locked transaction per user."""
+    counts = {}
+    for i, (email, full_name) in enumerate(candidates, 1):
+        with engine.begin() as conn:
+            lock_user(conn, email)
+            row = conn.execute(
+                text("SELECT user_id, plex_invite_status FROM users WHERE email=:e"), dict(e=email)
+            ).mappings().first()
+            if row["plex_invite_status"] in ("sent", "accepted"):
+                status = "skipped"
+            else:
+                status = send_plex_invite(conn, row["user_id"], email, full_name or "")
+        counts[status] = counts.get(status, 0) + 1
+        if i % 100 == 0 or i == len(candidates):
+            log(f"invites: {i}/{len(candidates)} processed {counts}")
+    return counts
+
+
+def run(kind: str, path: str, fmt: str, batch_size: int, invite: bool, write_sheets: bool):
+    init_db()
+    started = time.monotonic()
+
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        for attempt in range(1, MERGE_ATTEMPTS + 1):
+            records = read_records(path, fmt)
+            try:
+                if kind == "users":
+                    result = import_users(cur, records, batch_size)
+                else:
+                    result = import_payments(cur, records, batch_size)
+                raw.commit()
+                break
+            except psycopg2.errors.UniqueViolation as e:
+                # A live webhook committed one of these payments (or users) mid-import.
+                # The rollback drops the staging tables; on the retry the row already
+                # exists and is counted as a duplicate.
+                raw.rollback()
+                if attempt == MERGE_ATTEMPTS:
+                    raise
+                log(f"{kind}: conflict on {e.diag.constraint_name} with a concurrent write, "
+                    f"retrying ({attempt}/{MERGE_ATTEMPTS})")
+        log(f"{kind}: merged in {time.monotonic() - started:.1f}s {result}")
+
+        # Staging tables stay around until the finally block, so the deferred
+        # work below can still see which rows this import touched.
+        # Invites go first so the Sheets rows carry the resulting plex_invite_status.
+        if invite:
+            candidates = invite_candidates(cur, kind)
+            raw.commit()
+            result["invites"] = send_invites(candidates)
+
+        if write_sheets:
+            tab, rows = sheet_rows(cur, kind)
+            raw.commit()
+            for i in range(0, len(rows), SHEETS_BATCH):
+                sheets.append_rows(tab, rows[i:i + SHEETS_BATCH])
+                log(f"sheets: {min(i + SHEETS_BATCH, len(rows))}/{len(rows)} rows appended to {tab}")
+            result["sheet_rows"] = len(rows)
+    finally:
+        # The pool only rolls the connection back on close, which would leave
+        # committed temp tables behind for the next import on this connection
+        raw.rollback()
+        cur = raw.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {', '.join(STAGING_TABLES)}")
+        raw.commit()
+        raw.close()
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import users or Wave payments into Postgres.")
+    parser.add_argument("kind", choices=["users", "payments"])
+    parser.add_argument("path", help="CSV (with header row) or NDJSON file")
+    parser.add_argument("--format", choices=["csv", "ndjson"],
+                        help="input format (default: guessed from the file extension)")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows per COPY batch")
+    parser.add_argument("--invite", action="store_true",
+                        help="after the import, send Plex invites to imported users who don't have one")
+    parser.add_argument("--sheets", action="store_true",
+                        help="after the import, append the new rows to Google Sheets")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.path.lower().endswith(".csv") else "ndjson")
+    try:
+        result = run(args.kind, args.path, fmt, args.batch_size, args.invite, args.sheets)
+    except ValueError as e:
+        parser.exit(1, f"error: {e}\n")
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,19 @@ from datetime import datetime
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, EmailStr
 from sqlalchemy import text
 
-from .db import engine, init_db
-from .plex_service import invite_user, debug_connection
+from .db import engine, init_db, lock_user
+from .plex_service import debug_connection
+from .accounts import DEFAULT_PLAN_NAME, DEFAULT_PLAN_PRICE, send_plex_invite
 from . import sheets
 
 
 
 
 SHARED_WEBHOOK_SECRET = os.getenv("SHARED_WEBHOOK_SECRET", "")
-DEFAULT_PLAN_PRICE = float(os.getenv("DEFAULT_PLAN_PRICE", "9.00"))
-DEFAULT_PLAN_NAME = os.getenv("DEFAULT_PLAN_NAME", "Standard")
 
 # Public Wave checkout link – safe to expose
 WAVE_CHECKOUT_URL = os.getenv(
@@ -125,6 +125,9 @@ def verify_signature(raw_body: bytes, signature: str):
     return hmac.compare_digest(mac, signature or "")
 
 def upsert_user(conn, email: str, full_name: str | None):
+    # Hold the per-email lock for the rest of the caller's transaction so that
+    # invite/credit decisions based on the returned row can't race another worker
+    lock_user(conn, email)
     uid = f"u_{uuid.uuid4().hex[:10]}"
     conn.execute(text("""
         INSERT INTO users(user_id, email, full_name, status, join_date, plan, monthly_price)
@@ -143,7 +146,7 @@ class SignupFromWave(BaseModel):
 
 
 @app.post("/signup/from-wave")
-async def signup_from_wave(payload: SignupFromWave):
+def signup_from_wave(payload: SignupFromWave):
     """
     Create/update a user after successful checkout and add them to Google Sheets.
     """
@@ -152,17 +155,19 @@ async def signup_from_wave(payload: SignupFromWave):
     if payload.last_name:
         full_name = f"{payload.first_name} {payload.last_name}"
 
-    # 1) Upsert into database
+    # Same normalization as the webhook, so both land on one users row
+    email = payload.email.lower()
+
+    # 1) Upsert into database and 2) send Plex invite while holding the user lock.
+    #    The stored plex_invite_status is checked and written before the lock is
+    #    released, so repeat signups or a signup + webhook send only one invite.
     with engine.begin() as conn:
-        user_row = upsert_user(conn, payload.email, full_name)
+        user_row = upsert_user(conn, email, full_name)
         user_id = user_row["user_id"]
 
-    # 2) Send Plex invite using new invite_user helper
-    plex_status = "pending"
-    try:
-        plex_status = invite_user(payload.email, full_name)  # 'sent' | 'already_shared' | 'already_invited'
-    except Exception as e:
-        plex_status = f"error: {e.__class__.__name__}"
+        plex_status = user_row["plex_invite_status"]
+        if plex_status not in ("sent", "accepted"):
+            plex_status = send_plex_invite(conn, user_id, email, full_name)
 
     # 3) Append into Google Sheet (Users tab)
     sh = sheets.get_sheet()
@@ -176,7 +181,7 @@ async def signup_from_wave(payload: SignupFromWave):
     # monthly_price | credits_balance | plex_invite_status | plex_account_id | notes
     row = [
         user_id,                     # user_id
-        payload.email,               # email
+        email,                       # email
         full_name,                   # full_name
         "",                          # plex_username
         "",                          # referral_code_used
@@ -227,6 +232,11 @@ async def wave_webhook(request: Request):
     if event_type != "payment_succeeded":
         return JSONResponse({"ok": True, "ignored": True})
 
+    # DB work blocks (and may wait on another worker's per-email lock), so keep it off the event loop
+    return await run_in_threadpool(process_wave_payment, payload)
+
+
+def process_wave_payment(payload: dict):
     provider_event_id = payload["provider_event_id"]
     email = payload["email"].lower()
     full_name = payload.get("full_name", "")
@@ -332,94 +342,7 @@ async def wave_webhook(request: Request):
             invite_needed = False
 
         if invite_needed:
-            try:
-                status = invite_user(email, full_name)
-
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO invites(
-                            invite_id, user_id, email, plex_server,
-                            sent_at, status, attempts
-                        )
-                        VALUES(
-                            :iid, :uid, :email, :server,
-                            NOW(), :status, 1
-                        )
-                        """
-                    ),
-                    dict(
-                        iid=f"i_{uuid.uuid4().hex[:10]}",
-                        uid=user_id,
-                        email=email,
-                        server=os.getenv("PLEX_SERVER_NAME", ""),
-                        status=status,
-                    ),
-                )
-
-                conn.execute(
-                    text(
-                        """
-                        UPDATE users
-                        SET plex_invite_status = :status
-                        WHERE email = :email
-                        """
-                    ),
-                    dict(email=email, status=status),
-                )
-
-            except Exception as ex:
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO invites(
-                            invite_id, user_id, email, plex_server,
-                            sent_at, status, error_message, attempts
-                        )
-                        VALUES(
-                            :iid, :uid, :email, :server,
-                            NOW(), 'error', :msg, 1
-                        )
-                        """
-                    ),
-                    dict(
-                        iid=f"i_{uuid.uuid4().hex[:10]}",
-                        uid=user_id,
-                        email=email,
-                        server=os.getenv("PLEX_SERVER_NAME", ""),
-                        msg=str(ex),
-                    ),
-                )
-
-                conn.execute(
-                    text(
-                        """
-                        UPDATE users
-                        SET plex_invite_status = 'error'
-                        WHERE email = :email
-                        """
-                    ),
-                    dict(email=email),
-                )
-
-        # Append payment row to Google Sheets (best-effort)
-        try:
-            sheets.append_row(
-                "Payments",
-                [
-                    datetime.utcnow().isoformat(),
-                    email,
-                    amount,
-                    currency,
-                    provider_event_id,
-                    period_start,
-                    period_end,
-                    idempotency_key,
-                    "ok",
-                ],
-            )
-        except Exception:
-            pass
+            send_plex_invite(conn, user_id, email, full_name)
 
         # Audit log
         conn.execute(
@@ -436,6 +359,25 @@ async def wave_webhook(request: Request):
             ),
         )
 
+    # Append payment row to Google Sheets (best-effort, after the user lock is released)
+    try:
+        sheets.append_row(
+            "Payments",
+            [
+                datetime.utcnow().isoformat(),
+                email,
+                amount,
+                currency,
+                provider_event_id,
+                period_start,
+                period_end,
+                idempotency_key,
+                "ok",
+            ],
+        )
+    except Exception:
+        pass
+
     return {"ok": True, "user": email, "invite_sent": invite_needed}
 
 
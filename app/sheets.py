@@ -21,3 +21,14 @@ def append_row(sheet_name, row_values):
     except gspread.WorksheetNotFound:
         ws = sh.add_worksheet(title=sheet_name, rows=1, cols=len(row_values))
     ws.append_row(row_values, value_input_option="USER_ENTERED")
+
+def append_rows(sheet_name, rows):
+    """Append many rows in a single Sheets API call (used by bulk imports)."""
+    if not rows:
+        return
+    sh = get_sheet()
+    try:
+        ws = sh.worksheet(sheet_name)
+    except gspread.WorksheetNotFound:
+        ws = sh.add_worksheet(title=sheet_name, rows=1, cols=len(rows[0]))
+    ws.append_rows(rows, value_input_option="USER_ENTERED")
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+from sqlalchemy import text
+
+# app.db builds its engine from DATABASE_URL at import time, so point it at the
+# scratch database before any test imports the app
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+
+
+@pytest.fixture
+def db():
+    """Empty schema in the Postgres database named by TEST_DATABASE_URL."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("set TEST_DATABASE_URL to a scratch Postgres database")
+    from app.db import engine, init_db
+
+    init_db()
+    with engine.begin() as conn:
+        conn.execute(text("TRUNCATE users, payments, invites, referrals, audit_log RESTART IDENTITY"))
+    return engine
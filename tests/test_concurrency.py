@@ -0,0 +1,157 @@
+import socket, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+import uvicorn
+from sqlalchemy import text
+
+N_REQUESTS = 10
+EMAIL = "race@example.com"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _FakeSheet:
+    title = "Users"
+
+    def worksheet(self, name):
+        return self
+
+    def append_row(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def live_app(db, monkeypatch):
+    """Run the app under uvicorn with Plex/Sheets stubbed; yields (base_url, invite calls)."""
+    from app import accounts, main
+
+    calls = []
+    calls_lock = threading.Lock()
+
+    def fake_invite_user(email, full_name=""):
+        with calls_lock:
+            calls.append(email)
+        time.sleep(0.2)  # widen the window a racing request could slip through
+        return "sent"
+
+    real_upsert_user = main.upsert_user
+
+    def slow_upsert_user(conn, email, full_name):
+        # Stretch the gap between reading plex_invite_status and the first write to
+        # the user row; without the per-email lock every request reads it as unsent
+        row = real_upsert_user(conn, email, full_name)
+        time.sleep(0.2)
+        return row
+
+    monkeypatch.setattr(accounts, "invite_user", fake_invite_user)
+    monkeypatch.setattr(main, "upsert_user", slow_upsert_user)
+    monkeypatch.setattr(main.sheets, "append_row", lambda *a, **kw: None)
+    monkeypatch.setattr(main.sheets, "get_sheet", lambda: _FakeSheet())
+    monkeypatch.setattr(main, "SHARED_WEBHOOK_SECRET", "")
+
+    # An existing user with no invite yet (e.g. signed up before the first payment);
+    # for a brand-new email the unique index on users.email serializes the inserts
+    with db.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users(user_id, email, full_name, status, join_date)
+            VALUES('u_stress', :e, 'Race Condition', 'active', NOW())
+        """), dict(e=EMAIL))
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}", calls
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+
+def _fire(base_url, requests):
+    """POST all (path, json) requests at the same moment; returns the responses in order."""
+    barrier = threading.Barrier(len(requests))
+
+    def send(req):
+        path, body = req
+        with httpx.Client(base_url=base_url, timeout=30) as client:
+            barrier.wait()
+            return client.post(path, json=body)
+
+    with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+        return list(pool.map(send, requests))
+
+
+def _webhook(i):
+    return "/webhooks/wave", {
+        "event_type": "payment_succeeded",
+        "provider_event_id": f"evt-stress-{i}",
+        "email": "Race@Example.com",
+        "full_name": "Race Condition",
+        "amount": 7.00,
+        "currency": "USD",
+        "period_start": f"2025-{(i % 12) + 1:02d}-01",
+        "period_end": "2026-01-01",
+        "referral_code": "REF-STRESS",
+    }
+
+
+def _signup(i):
+    return "/signup/from-wave", {"email": "Race@Example.com", "first_name": "Race", "last_name": f"Condition {i}"}
+
+
+def _invite_state(db):
+    with db.connect() as conn:
+        user = conn.execute(text("SELECT credits_balance, plex_invite_status FROM users WHERE email = :e"), dict(e=EMAIL)).mappings().one()
+        users = conn.execute(text("SELECT COUNT(*) FROM users")).scalar()
+        invites = conn.execute(text("SELECT COUNT(*) FROM invites")).scalar()
+        referrals = conn.execute(text("SELECT COUNT(*) FROM referrals WHERE referred_email = :e"), dict(e=EMAIL)).scalar()
+    return user, users, invites, referrals
+
+
+def test_concurrent_webhooks_invite_and_credit_once(db, live_app):
+    base_url, calls = live_app
+    responses = _fire(base_url, [_webhook(i) for i in range(N_REQUESTS)])
+
+    assert [r.status_code for r in responses] == [200] * N_REQUESTS
+    assert calls == [EMAIL]
+
+    user, users, invites, referrals = _invite_state(db)
+    assert referrals == 1
+    assert user["credits_balance"] == 2
+    assert user["plex_invite_status"] == "sent"
+    assert invites == 1
+
+
+def test_concurrent_signups_invite_once(db, live_app):
+    base_url, calls = live_app
+    responses = _fire(base_url, [_signup(i) for i in range(N_REQUESTS)])
+
+    assert [r.status_code for r in responses] == [200] * N_REQUESTS
+    assert {r.json()["plex_invite_status"] for r in responses} == {"sent"}
+    assert calls == [EMAIL]
+
+    user, users, invites, _ = _invite_state(db)
+    assert user["plex_invite_status"] == "sent"
+    assert (users, invites) == (1, 1)
+
+
+def test_concurrent_signups_and_webhooks_invite_once(db, live_app):
+    base_url, calls = live_app
+    requests = [_signup(i) if i % 2 else _webhook(i) for i in range(N_REQUESTS)]
+    responses = _fire(base_url, requests)
+
+    assert [r.status_code for r in responses] == [200] * N_REQUESTS
+    assert calls == [EMAIL]
+
+    user, users, invites, referrals = _invite_state(db)
+    assert user["plex_invite_status"] == "sent"
+    assert (users, invites, referrals) == (1, 1, 1)
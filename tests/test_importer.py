@@ -0,0 +1,235 @@
+import csv, json, threading, time
+
+import pytest
+
+from sqlalchemy import text
+
+USERS_CSV = [
+    {"email": "Alice@Example.com", "full_name": "Alice Old", "plan": "Standard", "monthly_price": "7.00"},
+    {"email": "bob@example.com", "full_name": "Bob", "plan": "", "monthly_price": ""},
+    {"email": "", "full_name": "No Email"},
+    {"email": "alice@example.com", "full_name": "Alice New", "plan": "", "monthly_price": "9.00"},
+]
+
+PAYMENTS = [
+    {"provider_event_id": "evt-1", "email": "carol@example.com", "full_name": "Carol", "amount": 7,
+     "paid_at": "2025-01-05T10:00:00", "period_start": "2025-01-01", "period_end": "2025-02-01"},
+    {"provider_event_id": "evt-2", "email": "carol@example.com", "amount": 7,
+     "paid_at": "2025-02-05T10:00:00", "period_start": "2025-02-01", "period_end": "2025-03-01"},
+    # Same event replayed inside the file
+    {"provider_event_id": "evt-2", "email": "carol@example.com", "amount": 7,
+     "paid_at": "2025-02-05T10:00:00", "period_start": "2025-02-01", "period_end": "2025-03-01"},
+    # Undated history rows: keyed by provider_event_id, not collapsed into "email-None"
+    {"provider_event_id": "evt-3", "email": "dave@example.com", "amount": 5, "paid_at": "2024-06-01T00:00:00"},
+    {"provider_event_id": "evt-4", "email": "dave@example.com", "amount": 5, "paid_at": "2024-07-01T00:00:00"},
+    # No paid_at: stored as NULL, must not mark the payer as paid today
+    {"provider_event_id": "evt-5", "email": "grace@example.com", "amount": 7},
+    # Already recorded by the webhook before the import
+    {"provider_event_id": "evt-live", "email": "erin@example.com", "amount": 7,
+     "paid_at": "2025-03-05T10:00:00", "period_start": "2025-03-01", "period_end": "2025-04-01"},
+    # Nothing to deduplicate on
+    {"email": "frank@example.com", "amount": 3},
+]
+
+
+def _write_csv(path, rows, encoding="utf-8"):
+    with open(path, "w", newline="", encoding=encoding) as f:
+        writer = csv.DictWriter(f, fieldnames=["email", "full_name", "plan", "monthly_price"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _write_ndjson(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+def test_import_users_merges_and_is_rerunnable(db, tmp_path):
+    from app import importer
+
+    with db.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users(user_id, email, full_name, status, plan, monthly_price, plex_invite_status)
+            VALUES('u_existing', 'bob@example.com', 'Bob Existing', 'active', 'Premium', 12, 'sent')
+        """))
+
+    path = tmp_path / "users.csv"
+    _write_csv(path, USERS_CSV)
+
+    first = importer.run("users", str(path), "csv", 2, invite=False, write_sheets=False)
+    assert first == dict(staged=3, skipped=1, inserted=1, updated=1)
+
+    second = importer.run("users", str(path), "csv", 2, invite=False, write_sheets=False)
+    assert second == dict(staged=3, skipped=1, inserted=0, updated=2)
+
+    with db.connect() as conn:
+        users = {r["email"]: r for r in conn.execute(text("SELECT * FROM users")).mappings()}
+
+    assert set(users) == {"alice@example.com", "bob@example.com"}
+    # Last row wins; blank fields are NULL and fall back to defaults / existing values
+    assert users["alice@example.com"]["full_name"] == "Alice New"
+    assert users["alice@example.com"]["plan"] == importer.DEFAULT_PLAN_NAME
+    assert users["alice@example.com"]["monthly_price"] == 9
+    assert users["bob@example.com"]["user_id"] == "u_existing"
+    assert users["bob@example.com"]["full_name"] == "Bob"
+    assert users["bob@example.com"]["plan"] == "Premium"
+    assert users["bob@example.com"]["monthly_price"] == 12
+    assert users["bob@example.com"]["plex_invite_status"] == "sent"
+
+
+def test_import_users_csv_with_bom(db, tmp_path):
+    from app import importer
+
+    path = tmp_path / "export.csv"
+    _write_csv(path, USERS_CSV, encoding="utf-8-sig")
+
+    result = importer.run("users", str(path), "csv", 100, invite=False, write_sheets=False)
+    assert result == dict(staged=3, skipped=1, inserted=2, updated=0)
+
+
+def test_import_users_csv_without_email_column(db, tmp_path):
+    from app import importer
+
+    path = tmp_path / "users.csv"
+    path.write_text("mail,full_name\nalice@example.com,Alice\n")
+
+    with pytest.raises(ValueError, match="no 'email' column"):
+        importer.run("users", str(path), "csv", 100, invite=False, write_sheets=False)
+
+    # Staging tables were cleaned up, so the next import on the pool still works
+    _write_csv(path, USERS_CSV)
+    assert importer.run("users", str(path), "csv", 100, invite=False, write_sheets=False)["inserted"] == 2
+
+
+def test_import_payments_dedupes_and_is_rerunnable(db, tmp_path):
+    from app import importer
+
+    with db.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users(user_id, email, status, last_paid_date, next_due_date)
+            VALUES('u_erin', 'erin@example.com', 'active', '2026-01-01', '2026-01-31')
+        """))
+        conn.execute(text("""
+            INSERT INTO payments(payment_id, user_id, email, amount, provider, provider_event_id,
+                                 paid_at, status, idempotency_key)
+            VALUES('p_live', 'u_erin', 'erin@example.com', 7, 'Wave', 'evt-live',
+                   '2025-03-05', 'succeeded', 'erin@example.com-2025-03-01')
+        """))
+
+    path = tmp_path / "payments.ndjson"
+    _write_ndjson(path, PAYMENTS)
+
+    first = importer.run("payments", str(path), "ndjson", 3, invite=False, write_sheets=False)
+    assert first == dict(staged=8, skipped=0, inserted=5, duplicates=2, rejected=1, new_users=4)
+
+    second = importer.run("payments", str(path), "ndjson", 3, invite=False, write_sheets=False)
+    assert second == dict(staged=8, skipped=0, inserted=0, duplicates=7, rejected=1, new_users=0)
+
+    with db.connect() as conn:
+        payments = conn.execute(text(
+            "SELECT provider_event_id, idempotency_key, length(payment_id) AS id_len, paid_at, raw_payload "
+            "FROM payments ORDER BY provider_event_id"
+        )).mappings().all()
+        users = {r["email"]: r for r in conn.execute(text("SELECT * FROM users")).mappings()}
+
+    assert [p["provider_event_id"] for p in payments] == ["evt-1", "evt-2", "evt-3", "evt-4", "evt-5", "evt-live"]
+    keys = {p["provider_event_id"]: p["idempotency_key"] for p in payments}
+    assert keys["evt-1"] == "carol@example.com-2025-01-01"
+    assert keys["evt-3"] == "evt-3"
+    assert all(p["id_len"] == 34 for p in payments if p["provider_event_id"] != "evt-live")
+    assert payments[0]["raw_payload"]["full_name"] == "Carol"
+    assert payments[4]["paid_at"] is None
+
+    assert set(users) == {"carol@example.com", "dave@example.com", "erin@example.com", "frank@example.com",
+                          "grace@example.com"}
+    assert users["carol@example.com"]["full_name"] == "Carol"
+    assert str(users["carol@example.com"]["last_paid_date"]) == "2025-02-05 10:00:00"
+    assert str(users["carol@example.com"]["next_due_date"]) == "2025-03-07 10:00:00"
+    assert str(users["dave@example.com"]["last_paid_date"]) == "2024-07-01 00:00:00"
+    # Paid dates never move backwards
+    assert str(users["erin@example.com"]["last_paid_date"]) == "2026-01-01 00:00:00"
+    assert users["frank@example.com"]["last_paid_date"] is None
+    assert users["grace@example.com"]["last_paid_date"] is None
+    assert users["grace@example.com"]["next_due_date"] is None
+
+
+def test_import_payments_retries_after_concurrent_webhook_write(db, tmp_path, capsys):
+    from app import importer
+
+    with db.begin() as conn:
+        conn.execute(text("INSERT INTO users(user_id, email, status) VALUES('u_carol', 'carol@example.com', 'active')"))
+
+    # A webhook transaction that records evt-2 while the import is running: the
+    # import doesn't see it yet, blocks on the unique index, then hits the violation
+    started = threading.Event()
+
+    def webhook():
+        with db.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO payments(payment_id, user_id, email, amount, provider, provider_event_id,
+                                     paid_at, status, idempotency_key)
+                VALUES('p_webhook', 'u_carol', 'carol@example.com', 7, 'Wave', 'evt-2',
+                       NOW(), 'succeeded', 'carol@example.com-2025-02-01')
+            """))
+            started.set()
+            time.sleep(1)
+
+    thread = threading.Thread(target=webhook)
+    thread.start()
+    started.wait()
+
+    path = tmp_path / "payments.ndjson"
+    _write_ndjson(path, PAYMENTS)
+    try:
+        result = importer.run("payments", str(path), "ndjson", 100, invite=False, write_sheets=False)
+    finally:
+        thread.join()
+
+    assert "retrying (1/3)" in capsys.readouterr().err
+    assert result == dict(staged=8, skipped=0, inserted=5, duplicates=2, rejected=1, new_users=4)
+    with db.connect() as conn:
+        assert conn.execute(text("SELECT payment_id FROM payments WHERE provider_event_id = 'evt-2'")).scalar() == "p_webhook"
+
+
+def test_import_sends_invites_before_writing_sheets(db, tmp_path, monkeypatch):
+    from app import accounts, importer
+
+    invited = []
+    appended = []
+    monkeypatch.setattr(accounts, "invite_user", lambda email, full_name="": invited.append(email) or "sent")
+    monkeypatch.setattr(importer.sheets, "append_rows", lambda tab, rows: appended.append((tab, rows)))
+
+    path = tmp_path / "users.csv"
+    _write_csv(path, USERS_CSV)
+    result = importer.run("users", str(path), "csv", 100, invite=True, write_sheets=True)
+
+    assert sorted(invited) == ["alice@example.com", "bob@example.com"]
+    assert result["invites"] == {"sent": 2}
+    assert result["sheet_rows"] == 2
+    [(tab, rows)] = appended
+    assert tab == "Users"
+    assert [row[12] for row in rows] == ["sent", "sent"]
+
+
+def test_import_100k_payments(db, tmp_path):
+    from app import importer
+
+    path = tmp_path / "history.ndjson"
+    with open(path, "w") as f:
+        for i in range(100_000):
+            f.write(json.dumps({
+                "provider_event_id": f"evt-{i}",
+                "email": f"user{i % 20_000}@example.com",
+                "amount": 7,
+                "paid_at": f"2025-{(i // 20_000) + 1:02d}-05T10:00:00",
+                "period_start": f"2025-{(i // 20_000) + 1:02d}-01",
+            }) + "\n")
+
+    started = time.monotonic()
+    result = importer.run("payments", str(path), "ndjson", 50_000, invite=False, write_sheets=False)
+    elapsed = time.monotonic() - started
+
+    assert result["inserted"] == 100_000
+    assert result["new_users"] == 20_000
+    assert elapsed < 60, f"100k-row import took {elapsed:.1f}s"